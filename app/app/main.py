@@ -1,11 +1,30 @@
 from fastapi import FastAPI, Request
 from fastapi.responses import PlainTextResponse
+from logging.handlers import QueueHandler, QueueListener
+import logging
+import queue
 import os
 
 app = FastAPI()
 
 VERIFY_TOKEN = os.getenv("FB_VERIFY_TOKEN")
 
+# Handlers only enqueue records; the listener thread does the actual stream write
+log_queue = queue.Queue(-1)
+logger = logging.getLogger("webhook")
+logger.setLevel(logging.INFO)
+logger.addHandler(QueueHandler(log_queue))
+logger.propagate = False
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+
+@app.on_event("startup")
+def on_startup():
+    log_listener.start()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    log_listener.stop()
+
 @app.get("/webhook/facebook")
 async def verify(request: Request):
     mode = request.query_params.get("hub.mode")
@@ -19,5 +38,5 @@ async def verify(request: Request):
 @app.post("/webhook/facebook")
 async def webhook(request: Request):
     data = await request.json()
-    print("📩 Webhook event:", data)
+    logger.info("📩 Webhook event: %r", data)
     return PlainTextResponse(content="EVENT_RECEIVED", status_code=200)
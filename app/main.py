@@ -1,28 +1,69 @@
-import os, hmac, hashlib, json, urllib.parse
+import os, hmac, hashlib, base64, gzip, time, asyncio, secrets, logging
 from datetime import datetime, timezone
-from typing import Optional, Dict, Any
+from types import SimpleNamespace
+from typing import Optional, Dict, Any, List, AsyncIterator
 
-from fastapi import FastAPI, Request, Response, Depends, Header
-from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse, PlainTextResponse
+from fastapi import FastAPI, Request, Response, Depends, Header, Query, BackgroundTasks
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import RedirectResponse, HTMLResponse, ORJSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, ValidationError
 from dotenv import load_dotenv
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, ForeignKey
-from sqlalchemy.orm import sessionmaker, declarative_base, Session, relationship
+from sqlalchemy import event, func, text, select, insert, inspect, Column, Integer, String, DateTime, Text, ForeignKey
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 import httpx
+import orjson
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 ENV = os.getenv("ENV","development")
 BASE_URL = os.getenv("BASE_URL","http://localhost:8000")
 PORT = int(os.getenv("PORT","8000"))
 
+FB_PAGE_ID = os.getenv("FB_PAGE_ID","")
+FB_VERIFY_TOKEN = os.getenv("FB_VERIFY_TOKEN","")
+FB_CAPI_PIXEL_ID = os.getenv("FB_CAPI_PIXEL_ID")
+FB_CAPI_ACCESS_TOKEN = os.getenv("FB_CAPI_ACCESS_TOKEN")
+FB_CAPI_PATH = f"/v18.0/{FB_CAPI_PIXEL_ID}/events"  # relative to the shared Graph API client
+LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET","").encode('utf-8')
+LINE_ADD_FRIEND_LINK = os.getenv("LINE_ADD_FRIEND_LINK","https://line.me/R/ti/p/@YOUR_LINE_ID")
+SHOPEE_FALLBACK_URL = os.getenv("SHOPEE_FALLBACK_URL","https://shopee.co.th")
+MME_REF_PREFIX = f"https://m.me/{FB_PAGE_ID}?ref="
+
 DB_URL = os.getenv("DATABASE_URL","sqlite:///./data.db")
-engine = create_engine(DB_URL, echo=False, future=True)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+IS_SQLITE = DB_URL.startswith("sqlite")
+if DB_URL.startswith("sqlite:"):
+    # plain sqlite URLs (render.yaml, .env) are served through the aiosqlite driver;
+    # other databases must name an async driver themselves, e.g. postgresql+asyncpg://
+    DB_URL = DB_URL.replace("sqlite:", "sqlite+aiosqlite:", 1)
+engine = create_async_engine(
+    DB_URL, echo=False,
+    **({"poolclass": AsyncAdaptedQueuePool, "pool_size": 10} if IS_SQLITE else {}),
+)
+
+if IS_SQLITE:
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _):
+        # WAL lets readers run alongside the writer; NORMAL skips the per-commit fsync of FULL
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA busy_timeout=5000")
+        cur.execute("PRAGMA cache_size=-65536")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA foreign_keys=ON")
+        cur.close()
+
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 # --- Models ---
@@ -38,17 +79,18 @@ class Click(Base):
     utm_ad = Column(String(256), nullable=True)
     user_agent = Column(Text, nullable=True)
     ip = Column(String(64), nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, server_default=func.now())
 
-    choices = relationship("Choice", back_populates="click", cascade="all, delete-orphan")
-    lead = relationship("Lead", back_populates="click", uselist=False)
+    # lazy="raise": load children explicitly (e.g. selectinload(Click.choices)), never per row
+    choices = relationship("Choice", back_populates="click", cascade="all, delete-orphan", lazy="raise")
+    lead = relationship("Lead", back_populates="click", uselist=False, lazy="raise")
 
 class Choice(Base):
     __tablename__ = "choices"
     id = Column(Integer, primary_key=True)
     click_id = Column(Integer, ForeignKey("clicks.id"))
     dest = Column(String(32))  # line / messenger / shopee
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, server_default=func.now())
     click = relationship("Click", back_populates="choices")
 
 class Lead(Base):
@@ -58,37 +100,62 @@ class Lead(Base):
     ref_token = Column(String(32), unique=True, index=True)
     channel = Column(String(32))  # messenger or line
     external_user_id = Column(String(128))  # PSID or LINE userId
-    first_event_at = Column(DateTime, default=datetime.utcnow)
+    first_event_at = Column(DateTime, server_default=func.now())
     status = Column(String(32), default="new")
     raw = Column(Text, nullable=True)
     click = relationship("Click", back_populates="lead")
 
-def init_db():
-    Base.metadata.create_all(engine)
+# SQLite allows one writer at a time; queue writers here instead of on the pool
+write_lock = asyncio.Lock()
+
+def insert_ignore(model):
+    # INSERT ... ON CONFLICT DO NOTHING: rows that hit a unique key (ref_token, click_id)
+    # are skipped instead of failing, and rolling back, the whole batch
+    dialect = sqlite if engine.dialect.name == "sqlite" else postgresql
+    return dialect.insert(model).on_conflict_do_nothing()
+
+TIMESTAMP_COLUMNS = (("clicks", "created_at"), ("choices", "created_at"), ("leads", "first_event_at"))
 
-def get_db():
-    db = SessionLocal()
+def _check_timestamp_defaults(conn):
+    # create_all never alters existing tables: a data.db created before the columns got
+    # server_default=func.now() would store NULL timestamps on every new row
+    insp = inspect(conn)
+    for table, column in TIMESTAMP_COLUMNS:
+        cols = {c["name"]: c for c in insp.get_columns(table)}
+        if column in cols and cols[column].get("default") is None:
+            logger.warning("%s.%s has no database default; new rows will get NULL timestamps. "
+                           "See 'Upgrading an existing database' in README.md.", table, column)
+
+async def init_db():
     try:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    except OperationalError:
+        # another uvicorn worker created the tables first; the retry skips existing ones
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    async with engine.connect() as conn:
+        await conn.run_sync(_check_timestamp_defaults)
+
+async def get_db() -> AsyncIterator[AsyncSession]:
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # --- App ---
-app = FastAPI(title="PrepEng LinkHub PRO")
+app = FastAPI(title="PrepEng LinkHub PRO", default_response_class=ORJSONResponse)
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 
 # --- Utils ---
+REF_PATTERN = r"^[0-9a-f]{16}$"  # what new_ref() emits
+
 def new_ref() -> str:
-    seed = f"{datetime.now(timezone.utc).timestamp()}-{os.urandom(8).hex()}"
-    return hashlib.sha1(seed.encode()).hexdigest()[:16]
+    # 16 hex chars straight from the OS CSPRNG
+    return secrets.token_hex(8)
 
-def capi_send_facebook(event_name: str, click: Click, lead: Optional[Lead]=None):
-    pixel_id = os.getenv("FB_CAPI_PIXEL_ID")
-    access_token = os.getenv("FB_CAPI_ACCESS_TOKEN")
-    if not pixel_id or not access_token:
+async def capi_send_facebook(client: httpx.AsyncClient, event_name: str, click: Click, lead: Optional[Lead]=None):
+    if not FB_CAPI_PIXEL_ID or not FB_CAPI_ACCESS_TOKEN:
         return {"skipped":"missing fb capi config"}
-    url = f"https://graph.facebook.com/v18.0/{pixel_id}/events"
     # Minimal payload (improve hashing in production)
     data = {
         "data":[{
@@ -109,7 +176,7 @@ def capi_send_facebook(event_name: str, click: Click, lead: Optional[Lead]=None)
         }]
     }
     try:
-        r = httpx.post(url, params={"access_token": access_token}, json=data, timeout=10.0)
+        r = await client.post(FB_CAPI_PATH, params={"access_token": FB_CAPI_ACCESS_TOKEN}, json=data)
         return {"status": r.status_code, "resp": r.text[:200]}
     except Exception as e:
         return {"error": str(e)}
@@ -124,17 +191,47 @@ class TrackPayload(BaseModel):
     query: Dict[str, Any] = {}
     user_agent: Optional[str] = None
 
+# Messenger webhook: only the fields we read are typed; everything else is kept
+# (extra="allow") so the original message can still be stored in Lead.raw
+class FbModel(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+class FbSender(FbModel):
+    id: Optional[str] = None
+
+class FbReferral(FbModel):
+    ref: Optional[str] = None
+
+class FbPostback(FbModel):
+    referral: Optional[FbReferral] = None
+
+class FbMessaging(FbModel):
+    sender: Optional[FbSender] = None
+    referral: Optional[FbReferral] = None
+    postback: Optional[FbPostback] = None
+
+class FbEntry(FbModel):
+    messaging: List[FbMessaging] = []
+
+class FbWebhook(FbModel):
+    entry: List[FbEntry] = []
+
 # --- Routes ---
 @app.get("/choose", response_class=HTMLResponse)
-def choose_page(request: Request):
-    return templates.TemplateResponse("choose.html", {"request": request})
+async def choose_page(request: Request):
+    # choose.html has no per-request context, so it is rendered once at startup
+    headers = {"Cache-Control": "public, max-age=3600", "Vary": "Accept-Encoding"}
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return HTMLResponse(content=request.app.state.choose_gz, headers=headers)
+    return HTMLResponse(content=request.app.state.choose_html, headers=headers)
 
 @app.post("/track")
-def track_choice(payload: TrackPayload, request: Request, db: Session = Depends(get_db)):
+async def track_choice(payload: TrackPayload, request: Request, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
     # 1) store or create click
     q = payload.query or {}
     ref = new_ref()
-    click = Click(
+    values = dict(
         ref_token=ref,
         src=q.get("src") or "tiktok",
         ttclid=q.get("ttclid"),
@@ -145,103 +242,124 @@ def track_choice(payload: TrackPayload, request: Request, db: Session = Depends(
         user_agent=payload.user_agent or request.headers.get("user-agent",""),
         ip=request.client.host if request.client else None
     )
-    db.add(click)
-    db.flush()  # get click.id
-
-    ch = Choice(click_id=click.id, dest=payload.dest)
-    db.add(ch)
-    db.commit()
+    # Core inserts: two plain INSERTs, no identity map / unit-of-work bookkeeping
+    async with write_lock:
+        result = await db.execute(insert(Click).values(**values))
+        click_id = result.inserted_primary_key[0]
+        await db.execute(insert(Choice).values(click_id=click_id, dest=payload.dest))
+        await db.commit()
+    # plain attribute snapshot for the background tasks
+    click = SimpleNamespace(id=click_id, **values)
 
-    # Optional: fire CAPI/tiktok event for click
-    capi_send_facebook("LeadClick", click)
-    tiktok_events_api("Click", click)
+    # Optional: fire CAPI/tiktok event for click after the response is sent
+    background_tasks.add_task(capi_send_facebook, request.app.state.fb_client, "LeadClick", click)
+    background_tasks.add_task(tiktok_events_api, "Click", click)
 
     # 2) redirect target
     if payload.dest == "messenger":
-        page_id = os.getenv("FB_PAGE_ID","")
-        if not page_id:
-            return JSONResponse({"ok": False, "error":"FB_PAGE_ID missing"}, status_code=500)
-        url = f"https://m.me/{page_id}?ref={urllib.parse.quote(ref)}"
+        if not FB_PAGE_ID:
+            return ORJSONResponse({"ok": False, "error":"FB_PAGE_ID missing"}, status_code=500)
         return {"ok": True, "redirect_to": f"/go/messenger?ref={ref}"}
     elif payload.dest == "line":
         return {"ok": True, "redirect_to": f"/go/line?ref={ref}"}
     elif payload.dest == "shopee":
         return {"ok": True, "redirect_to": f"/go/shopee?ref={ref}"}
     else:
-        return JSONResponse({"ok": False, "error":"unknown dest"}, status_code=400)
+        return ORJSONResponse({"ok": False, "error":"unknown dest"}, status_code=400)
 
 @app.get("/go/messenger")
-def go_messenger(ref: str):
-    page_id = os.getenv("FB_PAGE_ID","")
-    url = f"https://m.me/{page_id}?ref={urllib.parse.quote(ref)}"
-    resp = RedirectResponse(url=url, status_code=302)
+async def go_messenger(ref: str = Query(..., pattern=REF_PATTERN)):
+    # ref is hex (checked by REF_PATTERN), no encoding needed
+    resp = RedirectResponse(url=MME_REF_PREFIX + ref, status_code=302)
     resp.set_cookie("pe_ref", ref, max_age=30*24*3600, httponly=True)
     return resp
 
 @app.get("/go/line")
-def go_line(ref: str):
+async def go_line(ref: str):
     # Log-only endpoint (click already stored); here you might create a 'prelead'
     # Then forward to LINE add-friend link
-    line_link = os.getenv("LINE_ADD_FRIEND_LINK","https://line.me/R/ti/p/@YOUR_LINE_ID")
-    resp = RedirectResponse(url=line_link, status_code=302)
+    resp = RedirectResponse(url=LINE_ADD_FRIEND_LINK, status_code=302)
     resp.set_cookie("pe_ref", ref, max_age=30*24*3600, httponly=True)
     return resp
 
 @app.get("/go/shopee")
-def go_shopee(ref: str, request: Request, db: Session = Depends(get_db)):
+async def go_shopee(ref: str, request: Request, db: AsyncSession = Depends(get_db)):
     # For Shopee, we can only attribute outbound clicks; purchases attribution lives in Shopee affiliate
-    shopee = os.getenv("SHOPEE_FALLBACK_URL","https://shopee.co.th")
-    resp = RedirectResponse(url=shopee, status_code=302)
+    resp = RedirectResponse(url=SHOPEE_FALLBACK_URL, status_code=302)
     resp.set_cookie("pe_ref", ref, max_age=7*24*3600, httponly=True)
     return resp
 
 # --- Facebook Webhook ---
 @app.get("/webhook/facebook")
-def fb_verify(mode: str = "", challenge: str = "", verify_token: str = ""):
-    if verify_token == os.getenv("FB_VERIFY_TOKEN",""):
+async def fb_verify(mode: str = "", challenge: str = "", verify_token: str = ""):
+    if verify_token == FB_VERIFY_TOKEN:
         return PlainTextResponse(challenge)
     return Response(status_code=403)
 
 @app.post("/webhook/facebook")
-async def fb_webhook(payload: Dict[str, Any], db: Session = Depends(get_db)):
-    # Parse basic structure
-    entry_list = payload.get("entry", [])
-    for entry in entry_list:
-        for msg in entry.get("messaging", []):
-            sender_id = msg.get("sender",{}).get("id")
+async def fb_webhook(request: Request, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+    # Validate straight from the body bytes (one pass, no intermediate dict)
+    try:
+        payload = FbWebhook.model_validate_json(await request.body())
+    except ValidationError as e:
+        # same shape as FastAPI's own body errors; don't echo the (possibly non-UTF-8) body back
+        raise RequestValidationError(
+            [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_input=False)]
+        )
+    new_leads = {}  # ref -> (click, lead row), committed together below
+    for entry in payload.entry:
+        for msg in entry.messaging:
+            sender_id = msg.sender.id if msg.sender else None
             ref = None
-            if "referral" in msg:
-                ref = msg["referral"].get("ref")
-            elif "postback" in msg and "referral" in msg["postback"]:
-                ref = msg["postback"]["referral"].get("ref")
-            if ref:
-                # find click and upsert lead
-                click = db.query(Click).filter(Click.ref_token==ref).one_or_none()
-                if click:
-                    lead = db.query(Lead).filter(Lead.ref_token==ref).one_or_none()
-                    if not lead:
-                        lead = Lead(click_id=click.id, ref_token=ref, channel="messenger",
-                                    external_user_id=sender_id, raw=json.dumps(msg))
-                        db.add(lead); db.commit()
-                        capi_send_facebook("Lead", click, lead)
+            if msg.referral:
+                ref = msg.referral.ref
+            elif msg.postback and msg.postback.referral:
+                ref = msg.postback.referral.ref
+            if ref and ref not in new_leads:
+                # find click and upsert lead (one lookup: the click plus its lead's id, if any)
+                row = (await db.execute(
+                    select(Click, Lead.id)
+                    .outerjoin(Lead, Lead.click_id==Click.id)
+                    .where(Click.ref_token==ref)
+                )).first()
+                if row:
+                    click, lead_id = row
+                    if lead_id is None:
+                        lead = dict(click_id=click.id, ref_token=ref, channel="messenger",
+                                    external_user_id=sender_id, raw=msg.model_dump_json(exclude_unset=True))
+                        new_leads[ref] = (click, lead)
+    if new_leads:
+        # The existence check above ran outside the lock, so a concurrent delivery may have
+        # inserted the same ref meanwhile; RETURNING tells us which rows this request wrote.
+        async with write_lock:
+            inserted = (await db.execute(
+                insert_ignore(Lead).returning(Lead.ref_token), [lead for _, lead in new_leads.values()]
+            )).scalars().all()
+            await db.commit()
+        for ref in inserted:
+            click, lead = new_leads[ref]
+            background_tasks.add_task(capi_send_facebook, request.app.state.fb_client, "Lead", click, SimpleNamespace(**lead))
     return {"ok": True}
 
 # --- LINE Webhook ---
 def verify_line_signature(body: bytes, signature: str) -> bool:
-    secret = os.getenv("LINE_CHANNEL_SECRET","")
-    if not secret or not signature:
+    if not LINE_CHANNEL_SECRET or not signature:
         return False
-    mac = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
-    import base64
-    return base64.b64encode(mac).decode('utf-8') == signature
+    mac = hmac.new(LINE_CHANNEL_SECRET, body, hashlib.sha256).digest()
+    try:
+        sig = base64.b64decode(signature, validate=True)
+    except ValueError:
+        return False
+    return hmac.compare_digest(mac, sig)
 
 @app.post("/webhook/line")
-async def line_webhook(request: Request, db: Session = Depends(get_db), x_line_signature: str = Header(None)):
+async def line_webhook(request: Request, db: AsyncSession = Depends(get_db), x_line_signature: str = Header(None)):
     raw = await request.body()
     if not verify_line_signature(raw, x_line_signature):
         return Response(status_code=403)
-    payload = json.loads(raw.decode('utf-8'))
+    payload = orjson.loads(raw)
     events = payload.get("events",[])
+    leads = {}  # ref_token -> row; first event per user wins, like one commit per event did
     for ev in events:
         ev_type = ev.get("type")
         user_id = ev.get("source",{}).get("userId")
@@ -252,22 +370,57 @@ async def line_webhook(request: Request, db: Session = Depends(get_db), x_line_s
         # Here we only log the first contact to create a lead without ref.
         if ev_type in ("follow","message") and user_id:
             # Create a generic lead without ref (or try to match heuristically)
-            lead = Lead(click_id=None, ref_token=f"line-{user_id[:10]}", channel="line",
-                        external_user_id=user_id, raw=json.dumps(ev))
-            db.add(lead); db.commit()
+            ref_token = f"line-{user_id[:10]}"
+            leads.setdefault(ref_token, dict(click_id=None, ref_token=ref_token, channel="line",
+                                             external_user_id=user_id, raw=orjson.dumps(ev).decode()))
+    if leads:
+        async with write_lock:
+            # users who already have a line-… lead are skipped, new users in the batch still land
+            await db.execute(insert_ignore(Lead), list(leads.values()))
+            await db.commit()
     return {"ok": True}
 
 # --- Minimal admin (demo) ---
+STATS_TTL = 10.0  # seconds; dashboard polling within the window reuses the last result
+_stats_cache = {"at": 0.0, "val": None}
+
 @app.get("/admin/stats")
-def admin_stats(db: Session = Depends(get_db)):
-    clicks = db.query(Click).count()
-    leads = db.query(Lead).count()
+async def admin_stats(db: AsyncSession = Depends(get_db)):
+    now = time.monotonic()
+    if _stats_cache["val"] is not None and now - _stats_cache["at"] < STATS_TTL:
+        return _stats_cache["val"]
+    clicks, leads = (await db.execute(text("SELECT (SELECT COUNT(*) FROM clicks), (SELECT COUNT(*) FROM leads)"))).one()
+    rows = (await db.execute(
+        select(Click.utm_campaign, func.count(Click.id)).group_by(Click.utm_campaign)
+    )).all()
     by_campaign = {}
-    for c in db.query(Click).all():
-        key = c.utm_campaign or "NA"
-        by_campaign[key] = by_campaign.get(key,0)+1
-    return {"clicks": clicks, "leads": leads, "clicks_by_campaign": by_campaign}
+    for campaign, n in rows:
+        key = campaign or "NA"
+        by_campaign[key] = by_campaign.get(key,0)+n
+    result = {"clicks": clicks, "leads": leads, "clicks_by_campaign": by_campaign}
+    _stats_cache.update(at=now, val=result)
+    return result
 
 @app.on_event("startup")
-def on_startup():
-    init_db()
+async def on_startup():
+    await init_db()
+    app.state.choose_html = templates.get_template("choose.html").render().encode("utf-8")
+    app.state.choose_gz = gzip.compress(app.state.choose_html, 9)
+    # Shared client so CAPI calls reuse pooled keep-alive connections to the Graph API
+    app.state.fb_client = httpx.AsyncClient(
+        base_url="https://graph.facebook.com",
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    )
+    if FB_CAPI_PIXEL_ID and FB_CAPI_ACCESS_TOKEN:
+        # Open the TLS connection now so the first click doesn't pay for the handshake
+        try:
+            await app.state.fb_client.head("/", timeout=5.0)
+        except httpx.HTTPError:
+            pass
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await app.state.fb_client.aclose()
+    await engine.dispose()